@@ -0,0 +1,148 @@
+#!/usr/bin/env ./.venv/bin/python
+import hashlib
+import itertools
+import struct
+import sys
+import zlib
+from logging import info
+from pathlib import Path
+from typing import BinaryIO, Iterator, Tuple
+
+import numpy as np
+
+from led_hw_any import LED_HW_Any
+
+###
+# Recording file format, all integers little endian:
+#   header: MAGIC, u16 width, u16 height, f32 fps
+#   frame:  16 byte blake2b hash of the raw rgb frame, u32 length,
+#           zlib compressed (frame xor previous frame), length 0 meaning
+#           identical to the previous frame.
+###
+MAGIC = b'LEDREC1\0'
+HEADER = struct.Struct('<HHf')
+FRAME = struct.Struct('<16sI')
+
+
+def frame_hash(frame: bytes) -> bytes:
+    return hashlib.blake2b(frame, digest_size=16).digest()
+
+
+class HW_Record(LED_HW_Any):
+    f: BinaryIO
+    prev: np.ndarray
+    n_frames: int
+
+    __slots__ = ['f', 'prev', 'n_frames']
+
+    def __init__(self, fn: Path, width: int, height: int, fps: float):
+        super().__init__(width, height)
+        self.f = fn.open('wb')
+        self.f.write(MAGIC + HEADER.pack(width, height, fps))
+        self.prev = np.zeros((height, width, 3), dtype=np.uint8)
+        self.n_frames = 0
+
+    def update(self, img: np.ndarray):
+        assert img.shape == self.prev.shape
+
+        delta = np.bitwise_xor(img, self.prev)
+        data = zlib.compress(delta.tobytes()) if delta.any() else b''
+        self.f.write(FRAME.pack(frame_hash(img.tobytes()), len(data)))
+        self.f.write(data)
+
+        self.prev[...] = img
+        self.n_frames += 1
+
+    def stop(self):
+        info(f'Recorded {self.n_frames} frames to {self.f.name}.')
+        self.running = False
+        self.f.close()
+
+
+def read_recording(fn: Path) -> Tuple[Tuple[int, int, float],
+                                      Iterator[Tuple[bytes, np.ndarray]]]:
+    f = fn.open('rb')
+    try:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{fn} is not a frame recording.')
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError(f'{fn} is truncated, header incomplete.')
+    except BaseException:
+        f.close()
+        raise
+    width, height, fps = HEADER.unpack(header)
+
+    def frames():
+        frame = np.zeros((height, width, 3), dtype=np.uint8)
+        with f:
+            while hdr := f.read(FRAME.size):
+                if len(hdr) < FRAME.size:
+                    raise ValueError(f'{fn} is truncated, frame incomplete.')
+                digest, length = FRAME.unpack(hdr)
+                if length:
+                    data = f.read(length)
+                    if len(data) < length:
+                        raise ValueError(
+                            f'{fn} is truncated, frame incomplete.')
+                    delta = np.frombuffer(zlib.decompress(data),
+                                          dtype=np.uint8)
+                    frame ^= delta.reshape(frame.shape)
+                yield digest, frame
+
+    return (width, height, fps), frames()
+
+
+def compare_recordings(golden_fn: Path, run_fn: Path) -> int:
+    (gw, gh, gfps), golden = read_recording(golden_fn)
+    (rw, rh, rfps), run = read_recording(run_fn)
+    if (gw, gh, gfps) != (rw, rh, rfps):
+        print(f'Format differs: golden {gw}x{gh}@{gfps}, run {rw}x{rh}@{rfps}.')
+        return 1
+
+    n_frames = 0
+    n_golden = 0
+    n_run = 0
+    n_diff = 0
+    first_diff = None
+    for g, r in itertools.zip_longest(golden, run):
+        n_golden += g is not None
+        n_run += r is not None
+        if g is None or r is None:
+            continue
+
+        (g_digest, g_frame), (r_digest, r_frame) = g, r
+        if g_digest != r_digest:
+            if first_diff is None:
+                n_pix = np.count_nonzero(np.any(g_frame != r_frame, axis=2))
+                first_diff = n_frames
+                print(f'Frame {n_frames} (t={n_frames / gfps:.3f}s) differs '
+                      f'in {n_pix} pixels.')
+            n_diff += 1
+        n_frames += 1
+
+    if n_golden != n_run:
+        print(f'Length differs: golden {n_golden} frames, run {n_run} frames.')
+        return 1
+
+    if n_diff:
+        print(f'{n_diff} of {n_frames} frames differ.')
+        return 1
+
+    print(f'All {n_frames} frames identical.')
+    return 0
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Compare a frame recording against a golden recording.')
+    parser.add_argument('golden', type=Path)
+    parser.add_argument('run', type=Path)
+    args = parser.parse_args()
+
+    try:
+        sys.exit(compare_recordings(args.golden, args.run))
+    except (OSError, ValueError) as exc:
+        print(exc)
+        sys.exit(2)
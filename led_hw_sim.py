@@ -7,19 +7,20 @@ import pygame
 import pygame.locals
 
 from led_hw_any import LED_HW_Any
+from led_sign import CommandQueue
 
 
 class HW_PyGame(LED_HW_Any):
     loop: asyncio.AbstractEventLoop
     scale: int
-    cmdq: asyncio.Queue
+    cmdq: CommandQueue
     window: pygame.Surface
     evt_consumer: asyncio.Task
 
     __slots__ = ['loop', 'scale', 'cmdq', 'window', 'evt_consumer']
 
     def __init__(self, loop: asyncio.AbstractEventLoop, width: int, height: int,
-                 scale: int, cmdq: asyncio.Queue[str]):
+                 scale: int, cmdq: CommandQueue):
         super().__init__(width, height)
         self.loop = loop
         self.scale = scale
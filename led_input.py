@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional, Set
+
+import evdev
+import evdev.ecodes
+
+from led_sign import CommandQueue
+
+logger = logging.getLogger(__name__)
+
+SCAN_NAME_PREFIX = 'PicoMK Pico Keyboard'
+
+KEYNAMES = {
+    evdev.ecodes.KEY_O: 'o',
+    evdev.ecodes.KEY_I: 'i',
+}
+
+
+class InputMonitor:
+    """
+    Watch /dev/input for controllers appearing and disappearing.
+
+    specs is a list of device paths, or "scan" to accept every device whose
+    name starts with SCAN_NAME_PREFIX. All devices found are grabbed and
+    their I/O keys are forwarded to cmdq, any number of them at once.
+    Devices are opened and probed in an executor so that a slow or hung
+    device never blocks the event loop.
+    """
+    cmdq: CommandQueue
+    scan: bool
+    paths: List[str]
+    poll_interval: float
+
+    readers: Dict[str, asyncio.Task]
+    rejected: Dict[str, int]  # path -> ctime of the rejected device node
+    main_task: Optional[asyncio.Task]
+
+    __slots__ = ['cmdq', 'scan', 'paths', 'poll_interval', 'readers',
+                 'rejected', 'main_task']
+
+    def __init__(self, cmdq: CommandQueue, specs: List[str],
+                 poll_interval: float = 1.0):
+        self.cmdq = cmdq
+        self.scan = 'scan' in specs
+        self.paths = [s for s in specs if s != 'scan']
+        self.poll_interval = poll_interval
+
+        self.readers = dict()
+        self.rejected = dict()
+        self.main_task = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self.main_task = loop.create_task(self.run())
+
+    def stop(self):
+        if self.main_task:
+            self.main_task.cancel()
+        for task in self.readers.values():
+            task.cancel()
+
+    # runs in executor: device paths present right now, with their ctime
+    # so that a node reused for a newly plugged device is probed again
+    def list_candidates(self) -> Dict[str, int]:
+        paths: Set[str] = set(self.paths)
+        if self.scan:
+            paths.update(evdev.list_devices())
+
+        ret = dict()
+        for path in paths:
+            try:
+                ret[path] = os.stat(path).st_ctime_ns
+            except OSError:
+                pass
+        return ret
+
+    # runs in executor: open device, check if it is a useable controller
+    def probe(self, path: str) -> Optional[evdev.InputDevice]:
+        try:
+            dev = evdev.InputDevice(path)
+        except OSError as exc:
+            logger.debug(f'Cannot open {path}: {exc}.')
+            return None
+
+        # the device may vanish at any point while probing
+        try:
+            reason = None
+            caps = dev.capabilities()
+            if self.scan and path not in self.paths and \
+                    not dev.name.startswith(SCAN_NAME_PREFIX):
+                reason = f'does not start with "{SCAN_NAME_PREFIX}"'
+            elif evdev.ecodes.EV_KEY not in caps:
+                reason = 'does not have EV_KEY capabilities'
+            elif not all(k in caps[evdev.ecodes.EV_KEY] for k in KEYNAMES):
+                reason = 'does not have "I" and "O" keys'
+
+            if reason:
+                logger.debug(f'Skipping {path} ({dev.name}), {reason}.')
+                dev.close()
+                return None
+
+            dev.grab()
+        except OSError as exc:
+            logger.warning(f'Cannot use {path}: {exc}.')
+            try:
+                dev.close()
+            except OSError:
+                pass
+            return None
+
+        return dev
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            try:
+                await self.scan_once(loop)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Exception caught scanning input devices!')
+
+            await asyncio.sleep(self.poll_interval)
+
+    async def scan_once(self, loop: asyncio.AbstractEventLoop):
+        candidates = await loop.run_in_executor(None, self.list_candidates)
+
+        for path, ctime in list(self.rejected.items()):
+            if candidates.get(path) != ctime:
+                del self.rejected[path]
+
+        for path, ctime in candidates.items():
+            if path in self.readers or path in self.rejected:
+                continue
+
+            dev = await loop.run_in_executor(None, self.probe, path)
+            if dev is None:
+                self.rejected[path] = ctime
+                continue
+
+            logger.info(f'Using {path} ({dev.name}) as control buttons.')
+            self.readers[path] = loop.create_task(self.reader(path, dev))
+
+    async def reader(self, path: str, dev: evdev.InputDevice):
+        key_pressed = dict()
+
+        try:
+            async for evt in dev.async_read_loop():
+                evt: evdev.InputEvent
+
+                logger.debug(f'{path}: {evt}')
+
+                if evt.type != evdev.ecodes.EV_KEY:
+                    continue
+
+                keyname = KEYNAMES.get(evt.code)
+                if keyname is None:
+                    continue
+
+                if evt.value and not key_pressed.get(keyname):
+                    key_pressed[keyname] = 1
+                    self.cmdq.put_nowait(keyname + '_pressed')
+                elif not evt.value and key_pressed.get(keyname):
+                    key_pressed[keyname] = 0
+                    self.cmdq.put_nowait(keyname + '_released')
+        except OSError as exc:
+            logger.info(f'Controller {path} removed ({exc}).')
+        except Exception:
+            logger.exception(f'Exception caught reading {path}!')
+        finally:
+            # don't leave the flash on when unplugged while pressed
+            for keyname, pressed in key_pressed.items():
+                if pressed:
+                    self.cmdq.put_nowait(keyname + '_released')
+            try:
+                dev.close()
+            except OSError:
+                pass
+            del self.readers[path]
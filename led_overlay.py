@@ -0,0 +1,215 @@
+import math
+import time
+from abc import abstractmethod, ABC
+from typing import Hashable, Optional, Tuple
+
+import PIL.Image, PIL.ImageDraw
+import numpy as np
+
+from led_page import load_font_5x8
+
+
+class LEDOverlay(ABC):
+    """
+    Layer composited on top of the pages by LEDSign.
+
+    Subclasses say what to show via content() and draw it via render(), the
+    overlay is only re-rendered when the content key changes and otherwise
+    blended from a cache, cropped to the pixels it covers: either a plain
+    copy through a boolean mask if alpha is 0 or 255 everywhere, or an
+    integer blend with premultiplied color.
+    """
+    width: int
+    height: int
+
+    key: Optional[Hashable]
+    valid_until: float
+
+    # latest value posted from any thread, and the one content() works with
+    posted: object
+    seen: object
+
+    # cached composite, cropped to the bounding box of non-transparent pixels
+    bbox: Optional[Tuple[slice, slice]]
+    rgb: np.ndarray  # [h,w,3(rgb)] uint8
+    mask: Optional[np.ndarray]  # [h,w] bool, None if alpha is not binary
+    premul: np.ndarray  # [h,w,3] uint16, rgb * alpha + 127
+    inv_alpha: np.ndarray  # [h,w,1] uint16, 255 - alpha
+    tmp: np.ndarray  # [h,w,3] uint16
+
+    __slots__ = ['width', 'height', 'key', 'valid_until', 'posted', 'seen',
+                 'bbox', 'rgb', 'mask', 'premul', 'inv_alpha', 'tmp']
+
+    def __init__(self, width: int, height: int, posted: object = None):
+        self.width = width
+        self.height = height
+        self.key = None
+        self.valid_until = -math.inf
+        self.posted = posted
+        self.seen = None
+        self.bbox = None
+
+    # Hand a new value to the render side, safe from any thread as it is a
+    # single attribute store, picked up by the next frame rendered.
+    def post(self, value: object):
+        self.posted = value
+
+    # Key of what to show at time now (None: nothing) and the time up to
+    # which it stays the same, until then content() isn't called again
+    # unless something new is posted.
+    @abstractmethod
+    def content(self, now: float) -> Tuple[Optional[Hashable], float]:
+        pass
+
+    # draw the content for key, [height,width,4(rgba)] uint8
+    @abstractmethod
+    def render(self, key: Hashable) -> np.ndarray:
+        pass
+
+    def update(self, now: float):
+        posted = self.posted
+        if now < self.valid_until and posted is self.seen:
+            return
+        self.seen = posted
+        key, self.valid_until = self.content(now)
+        if key == self.key:
+            return
+        self.key = key
+        self.bbox = None
+        if key is None:
+            return
+
+        rgba = self.render(key)
+        alpha = rgba[:, :, 3]
+        ys, = np.nonzero(alpha.any(axis=1))
+        xs, = np.nonzero(alpha.any(axis=0))
+        if not len(ys):
+            return
+
+        self.bbox = slice(int(ys[0]), int(ys[-1]) + 1), \
+            slice(int(xs[0]), int(xs[-1]) + 1)
+        rgba = rgba[self.bbox]
+        alpha = rgba[:, :, 3:].astype(np.uint16)
+
+        self.rgb = np.ascontiguousarray(rgba[:, :, :3])
+        self.mask = None
+        if np.all((alpha == 0) | (alpha == 255)):
+            self.mask = alpha[:, :, 0] == 255
+        else:
+            self.premul = self.rgb * alpha + 127
+            self.inv_alpha = 255 - alpha
+            self.tmp = np.zeros(self.rgb.shape, dtype=np.uint16)
+
+    # blend onto out [height,width,3(rgb)] in place
+    def composite(self, out: np.ndarray, now: float):
+        self.update(now)
+        if self.bbox is None:
+            return
+
+        region = out[self.bbox]
+        if self.mask is not None:
+            np.copyto(region, self.rgb, where=self.mask[:, :, None])
+            return
+
+        np.multiply(region, self.inv_alpha, out=self.tmp)
+        self.tmp += self.premul
+        self.tmp //= 255
+        region[...] = self.tmp
+
+
+class TextOverlay(LEDOverlay):
+    """
+    One line of text in the 5x8 font of LEDTextPage, on a box of bg_alpha
+    black (0: text only, 255: opaque).
+    """
+    color_rgb: Tuple[int, int, int]
+    align: str
+    bg_alpha: int
+
+    __slots__ = ['color_rgb', 'align', 'bg_alpha']
+
+    def __init__(self, width: int, height: int, text: str,
+                 color_rgb: Tuple[int, int, int], align: str = 'left',
+                 bg_alpha: int = 255):
+        super().__init__(width, height, text)
+        self.color_rgb = color_rgb
+        self.align = align
+        self.bg_alpha = bg_alpha
+
+    def set_text(self, text: str):
+        self.post(text)
+
+    def content(self, now: float):
+        return (self.seen or None), math.inf
+
+    def render(self, key: str) -> np.ndarray:
+        font = load_font_5x8()
+        text_w = int(font.getbbox(key)[2])
+        if self.align == 'right':
+            x = self.width - text_w
+        elif self.align == 'center':
+            x = (self.width - text_w) // 2
+        else:
+            x = 0
+
+        pil_img = PIL.Image.new('RGBA', (self.width, self.height),
+                                (0, 0, 0, 0))
+        draw = PIL.ImageDraw.Draw(pil_img)
+        if self.bg_alpha:
+            # one column of padding left and right
+            draw.rectangle((x - 1, 0, x + text_w, self.height - 1),
+                           fill=(0, 0, 0, self.bg_alpha))
+        draw.text((x, 0), key, fill=self.color_rgb + (255,), font=font)
+        return np.array(pil_img)
+
+
+class ClockOverlay(TextOverlay):
+    fmt: str
+    period: float
+    utc: bool
+
+    __slots__ = ['fmt', 'period', 'utc']
+
+    def __init__(self, width: int, height: int, fmt: str,
+                 color_rgb: Tuple[int, int, int], align: str = 'right',
+                 bg_alpha: int = 255, utc: bool = False):
+        super().__init__(width, height, '', color_rgb, align, bg_alpha)
+        self.fmt = fmt
+        # re-render every second only if the format shows seconds at all
+        # (%S, %T, %c, %s, ...), the finest unit below that is the minute
+        self.period = 60.0
+        if time.strftime(fmt, time.gmtime(0)) != \
+                time.strftime(fmt, time.gmtime(1)):
+            self.period = 1.0
+        self.utc = utc
+
+    def content(self, now: float):
+        tm = time.gmtime(now) if self.utc else time.localtime(now)
+        return time.strftime(self.fmt, tm), \
+            now - now % self.period + self.period
+
+
+class NotificationOverlay(TextOverlay):
+    shown: Optional[Tuple[str, float]]
+    expires: float
+
+    __slots__ = ['shown', 'expires']
+
+    def __init__(self, width: int, height: int,
+                 color_rgb: Tuple[int, int, int], align: str = 'center',
+                 bg_alpha: int = 255):
+        super().__init__(width, height, '', color_rgb, align, bg_alpha)
+        self.shown = None
+        self.expires = -math.inf
+
+    # show text for duration seconds, may be called from any thread
+    def push(self, text: str, duration: float):
+        self.post((text, duration))
+
+    def content(self, now: float):
+        if self.seen and self.seen is not self.shown:
+            self.shown = self.seen
+            self.expires = now + self.shown[1]
+        if now >= self.expires:
+            return None, math.inf
+        return (self.shown[0] or None), self.expires
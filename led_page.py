@@ -1,12 +1,36 @@
 from abc import abstractmethod, ABC
 from logging import info, warning, error
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Hashable, List, Optional, Tuple
 
 import PIL.Image, PIL.ImageFont, PIL.ImageDraw
 import numpy as np
 
 
+def palettize(arr: np.ndarray) -> Tuple[Optional[np.ndarray], np.ndarray]:
+    """
+    Split a [...,3(rgb)] image into a palette [n-colors,3(rgb)] and a
+    uint8 index plane [...]. Images with more than 256 colors are returned
+    unchanged with a palette of None.
+    """
+    flat = arr.reshape(-1, 3).astype(np.uint32)
+    packed = (flat[:, 0] << 16) | (flat[:, 1] << 8) | flat[:, 2]
+    colors, inverse = np.unique(packed, return_inverse=True)
+    if len(colors) > 256:
+        return None, arr
+
+    palette = np.stack([colors >> 16, colors >> 8, colors], axis=1)
+    return (palette & 0xff).astype(np.uint8), \
+        inverse.reshape(arr.shape[:-1]).astype(np.uint8)
+
+
+def clamp_brightness(arr: np.ndarray, limit: int) -> Tuple[np.ndarray, int]:
+    vmax = int(np.amax(arr))
+    if vmax > limit:
+        arr = np.round(arr * (limit / vmax)).astype(np.uint8)
+    return arr, vmax
+
+
 class LEDPage(ABC):
     width: int
     height: int
@@ -45,7 +69,25 @@ class LEDPage(ABC):
     def get(self) -> np.ndarray:
         pass
 
-    def rotate(self, src: np.ndarray) -> np.ndarray:
+    # Key uniquely identifying the image the next get() will return, or
+    # None if the page content is not a pure function of its state. Pages
+    # returning a key allow the sign to serve repeating frames from a cache.
+    def cycle_key(self) -> Optional[Hashable]:
+        return None
+
+    # Advance the page exactly like get() would, without rendering.
+    def skip(self):
+        self.get()
+
+    # Everything tick() and get() change, so that the sign can rewind
+    # pages to a frame it rendered ahead.
+    def save_state(self) -> tuple:
+        return self.x_offset, self.x_increment
+
+    def restore_state(self, state: tuple):
+        self.x_offset, self.x_increment = state
+
+    def advance_offset(self) -> int:
         x_offs_int = int(round(self.x_offset))
 
         self.x_offset += self.x_increment
@@ -54,17 +96,67 @@ class LEDPage(ABC):
         while self.x_offset > self.width:
             self.x_offset -= self.width
 
-        return np.roll(src, x_offs_int, axis=1)
+        return x_offs_int
 
+    # like np.roll(src, offset, axis=1), but into a preallocated array
+    def rotate(self, src: np.ndarray, out: np.ndarray) -> np.ndarray:
+        x_offs_int = self.advance_offset() % self.width
+        out[:, x_offs_int:] = src[:, :self.width - x_offs_int]
+        out[:, :x_offs_int] = src[:, self.width - x_offs_int:]
+        return out
 
-class LEDStaticImage(LEDPage):
-    img: np.ndarray
+
+class LEDPalettePage(LEDPage):
+    """
+    Page storing its pixels either as uint8 indices into a palette of at
+    most 256 colors (pixel art), or as plain rgb if there are more colors
+    (photos). get() returns a buffer that is reused by the next call.
+    """
+    palette: Optional[np.ndarray]  # [n-colors,3(rgb)] or None if rgb
+    buf: np.ndarray  # [height,width,3(rgb)]
+    idx_buf: Optional[np.ndarray]  # [height,width]
+
+    __slots__ = ['palette', 'buf', 'idx_buf']
+
+    def __init__(self, width: int, height: int,
+                 palette: Optional[np.ndarray]):
+        super().__init__(width, height)
+        self.palette = palette
+        self.buf = np.zeros((height, width, 3), dtype=np.uint8)
+        self.idx_buf = None
+        if palette is not None:
+            self.idx_buf = np.zeros((height, width), dtype=np.uint8)
+
+    def expand(self, src: np.ndarray) -> np.ndarray:
+        if self.palette is None:
+            return self.rotate(src, self.buf)
+        self.rotate(src, self.idx_buf)
+        return np.take(self.palette, self.idx_buf, axis=0, out=self.buf,
+                       mode='clip')
+
+    # rgb values (of the palette if there is one) to apply color effects to
+    @abstractmethod
+    def colors(self) -> np.ndarray:
+        pass
+
+    @abstractmethod
+    def set_colors(self, colors: np.ndarray):
+        pass
+
+    def limit_brightness(self, limit: int) -> int:
+        colors, vmax = clamp_brightness(self.colors(), limit)
+        self.set_colors(colors)
+        return vmax
+
+
+class LEDStaticImage(LEDPalettePage):
+    img: np.ndarray  # [height,width] palette indices or [height,width,3(rgb)]
 
     __slots__ = ['img']
 
     def __init__(self, img: np.ndarray):
-        super().__init__(img.shape[1], img.shape[0])  # width/height
-        self.img = img
+        palette, self.img = palettize(img)
+        super().__init__(img.shape[1], img.shape[0], palette)  # width/height
 
     @classmethod
     def from_file_image(cls, fn: Path, limit_brightness: int):
@@ -73,22 +165,38 @@ class LEDStaticImage(LEDPage):
             warning(f'Image {fn} is not mode RGB, but {img.mode}.')
             img = img.convert('RGB')
 
-        arr = np.array(img)
-        vmax = np.amax(arr)
+        page = cls(np.array(img))
+        vmax = page.limit_brightness(limit_brightness)
         if vmax > limit_brightness:
             info(f'{fn}: too bright {vmax}, limiting to {limit_brightness}...')
-            arr = np.round(arr * (limit_brightness / vmax)).astype(np.uint8)
-        return cls(arr)
+        return page
+
+    def colors(self):
+        return self.img if self.palette is None else self.palette
+
+    def set_colors(self, colors: np.ndarray):
+        if self.palette is None:
+            self.img = colors
+        else:
+            self.palette = colors
 
     def get(self):
-        return self.rotate(self.img)
+        return self.expand(self.img)
+
+    def cycle_key(self):
+        return int(round(self.x_offset)) % self.width
+
+    def skip(self):
+        self.advance_offset()
 
     def tick(self, dt: float):
         pass
 
 
-class LEDAnimation(LEDPage):
-    img_arr: np.ndarray  # [n-frames,height,width,3(rgb)]
+class LEDAnimation(LEDPalettePage):
+    # [n-frames,height,width] palette indices, one palette for all frames,
+    # or [n-frames,height,width,3(rgb)]
+    img_arr: np.ndarray
     time_arr: List[float]
     img_ix: int
     frame_dt: float
@@ -97,8 +205,8 @@ class LEDAnimation(LEDPage):
 
     def __init__(self, width: int, height: int, img_arr: np.ndarray,
                  time_arr: List[float]):
-        super().__init__(width, height)
-        self.img_arr = img_arr
+        palette, self.img_arr = palettize(img_arr)
+        super().__init__(width, height, palette)
         self.time_arr = time_arr
         self.img_ix = 0
         self.frame_dt = 0.0
@@ -145,15 +253,15 @@ class LEDAnimation(LEDPage):
 
         frames = np.stack(frames, 0)
 
-        vmax = np.amax(frames)
+        page = cls(shape[1], shape[0], frames, time_arr)
+        vmax = page.limit_brightness(limit_brightness)
         if vmax > limit_brightness:
             error(f'{fn}: too bright {vmax}, limiting to {limit_brightness}...')
-            frames = np.round(frames * (limit_brightness / vmax)).astype(
-                np.uint8)
 
         info(
-            f'Animation with {frames.shape[0]} frames of size {frames.shape[2]} x {frames.shape[1]}.')
-        return cls(shape[1], shape[0], frames, time_arr)
+            f'Animation with {frames.shape[0]} frames of size {frames.shape[2]} x {frames.shape[1]}'
+            f', {"rgb" if page.palette is None else f"{len(page.palette)} colors"}.')
+        return page
 
     def tick(self, dt: float):
         self.frame_dt += dt
@@ -163,22 +271,46 @@ class LEDAnimation(LEDPage):
             if self.img_ix >= len(self.img_arr):
                 self.img_ix = 0
 
+    def colors(self):
+        return self.img_arr if self.palette is None else self.palette
+
+    def set_colors(self, colors: np.ndarray):
+        if self.palette is None:
+            self.img_arr = colors
+        else:
+            self.palette = colors
+
     def get(self):
-        return self.rotate(self.img_arr[self.img_ix])
+        return self.expand(self.img_arr[self.img_ix])
+
+    def cycle_key(self):
+        return self.img_ix, int(round(self.x_offset)) % self.width
+
+    def skip(self):
+        self.advance_offset()
+
+    def save_state(self):
+        return super().save_state(), self.img_ix, self.frame_dt
+
+    def restore_state(self, state: tuple):
+        base, self.img_ix, self.frame_dt = state
+        super().restore_state(base)
 
 
 font_5x8: Optional[PIL.ImageFont.ImageFont] = None
 
 
-class LEDTextPage(LEDStaticImage):
-    def __init__(self, width: int, height: int, text: str, color_rgb: Tuple[int, int, int]):
+def load_font_5x8() -> PIL.ImageFont.ImageFont:
+    global font_5x8
+    if font_5x8 is None:
+        font_5x8 = PIL.ImageFont.load('font_5x8.pil')
+    return font_5x8
 
-        global font_5x8
-        if font_5x8 is None:
-            font_5x8 = PIL.ImageFont.load('font_5x8.pil')
 
+class LEDTextPage(LEDStaticImage):
+    def __init__(self, width: int, height: int, text: str, color_rgb: Tuple[int, int, int]):
         pil_img = PIL.Image.new('RGB', (width, height), (0, 0, 0))
         draw = PIL.ImageDraw.Draw(pil_img)
-        draw.text((0, 0), text, fill=color_rgb, font=font_5x8)
+        draw.text((0, 0), text, fill=color_rgb, font=load_font_5x8())
 
         super().__init__(np.array(pil_img))
@@ -1,19 +1,78 @@
 import asyncio
+import gc
 import logging
+import os
 import random
-from typing import Union, Tuple, List
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Union, Tuple, List, Dict, Hashable, Optional, Callable
 
 import numpy as np
 
 from led_page import LEDPage
 from led_hw_any import LED_HW_Any
+from led_overlay import LEDOverlay
 
 logger = logging.getLogger(__name__)
 
+# upper bound of frames kept for a periodic page, 1024 frames of 128x8
+# pixels are 3 MiB
+CYCLE_CACHE_MAX = 1024
+
+# with deferred gc, only collect if at least this much time is left until
+# the next frame is due, unless garbage is piling up anyway
+GC_IDLE_MARGIN = 0.002
+GC_FORCE_FACTOR = 10
+
+
+class CommandQueue:
+    """
+    Drop-in for the asyncio.Queue methods used to pass commands to the
+    sign, but usable from any thread: deque.append() and popleft() are
+    atomic and never block, so producers can't stall the render thread.
+    """
+    dq: deque
+
+    __slots__ = ['dq']
+
+    def __init__(self):
+        self.dq = deque()
+
+    def put_nowait(self, cmd: str):
+        self.dq.append(cmd)
+
+    def get_nowait(self) -> str:
+        return self.dq.popleft()
+
+    def empty(self) -> bool:
+        return not self.dq
+
+
+def set_thread_scheduling(rt_priority: Optional[int],
+                          cpus: Optional[List[int]]):
+    # on linux, pid 0 refers to the calling thread only
+    if cpus:
+        try:
+            os.sched_setaffinity(0, cpus)
+            logger.info(f'Render thread pinned to cpus {cpus}.')
+        except (AttributeError, OSError) as exc:
+            logger.warning(f'Cannot set cpu affinity ({exc}), ignored.')
+    if rt_priority:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO,
+                                  os.sched_param(rt_priority))
+            logger.info(f'Render thread has realtime priority {rt_priority}.')
+        except (AttributeError, OSError) as exc:
+            logger.warning(f'Cannot set realtime priority ({exc}), running '
+                           'with normal priority.')
+
 
 class LEDSign:
     hw: LED_HW_Any
     pages: List[LEDPage]
+    overlays: List[LEDOverlay]  # bottom to top
 
     page_ix: Union[Tuple[int, int], int]
     page_time: float
@@ -24,24 +83,49 @@ class LEDSign:
     randomize_pages: bool
     output_active: bool
     flash_active: bool
+    defer_gc: bool
 
-    cmdq: asyncio.Queue
+    cmdq: CommandQueue
 
     all_white_img: np.ndarray
     all_black_img: np.ndarray
     fade_img: np.ndarray
     fade_tmp: np.ndarray
 
-    __slots__ = ['hw', 'pages', 'page_ix', 'page_time', 'fade_time',
+    # render-ahead ring of frames ready for output, with the state of the
+    # sign and its pages from just before each frame was rendered
+    ring: np.ndarray  # [render_ahead,height,width,3(rgb)]
+    ring_state: List[Optional[tuple]]
+    ring_head: int
+    ring_count: int
+
+    # frames of the currently displayed page, indexed by page.cycle_key()
+    cycle_page: Optional[LEDPage]
+    cycle_cache: Dict[Hashable, np.ndarray]
+
+    # Overlays see the wall clock time a frame is output at, not the time
+    # it is rendered: frame_no counts frames in output order (rewound by
+    # invalidate()), frame frame_no is due at time_base + frame_no * dt_secs
+    # on the frame loop clock, wall_offset converts that to wall clock time.
+    frame_no: int
+    time_base: float
+    wall_offset: float
+
+    __slots__ = ['hw', 'pages', 'overlays', 'page_ix', 'page_time', 'fade_time',
                  'dt_remain', 'dt_secs', 'randomize_pages', 'output_active',
-                 'flash_active', 'cmdq', 'all_white_img', 'all_black_img',
-                 'fade_img', 'fade_tmp', ]
+                 'flash_active', 'defer_gc', 'cmdq', 'all_white_img', 'all_black_img',
+                 'fade_img', 'fade_tmp', 'ring', 'ring_state', 'ring_head',
+                 'ring_count',
+                 'cycle_page', 'cycle_cache', 'frame_no', 'time_base',
+                 'wall_offset', ]
 
     def __init__(self, hw: LED_HW_Any, page_time: float,
-                 fade_time: float, fps: float, cmdq: asyncio.Queue,
-                 randomize_pages: bool):
+                 fade_time: float, fps: float, cmdq: CommandQueue,
+                 randomize_pages: bool, render_ahead: int = 3,
+                 defer_gc: bool = False):
         self.hw = hw
         self.pages = []
+        self.overlays = []
 
         self.page_ix = 0
         self.page_time = page_time
@@ -52,6 +136,7 @@ class LEDSign:
         self.randomize_pages = randomize_pages
         self.output_active = True
         self.flash_active = False
+        self.defer_gc = defer_gc
 
         self.cmdq = cmdq
 
@@ -64,86 +149,299 @@ class LEDSign:
         self.fade_img = np.zeros((hw.height, hw.width, 3), dtype='f')
         self.fade_tmp = np.zeros((hw.height, hw.width, 3), dtype='f')
 
+        self.ring = np.zeros((max(1, render_ahead), hw.height, hw.width, 3),
+                             dtype=np.uint8)
+        self.ring_state = [None] * len(self.ring)
+        self.ring_head = 0
+        self.ring_count = 0
+
+        self.cycle_page = None
+        self.cycle_cache = dict()
+
+        self.frame_no = 0
+        self.time_base = 0.0
+        self.wall_offset = time.time()
+
     def add_page(self, page: LEDPage):
         self.pages.append(page)
 
-    async def mainloop(self):
-        while self.hw.running:
-            if not self.cmdq.empty():
-                cmd = self.cmdq.get_nowait()
+    def add_overlay(self, overlay: LEDOverlay):
+        self.overlays.append(overlay)
+
+    def process_cmd(self, cmd: str):
+        # flash and blackout are applied when a frame is output, so they
+        # preempt all frames already queued in the ring
+        if cmd == 'i_pressed':
+            logger.info('Blitzdings on!')
+            self.flash_active = True
+        elif cmd == 'i_released':
+            logger.info('Blitzdings off!')
+            self.flash_active = False
+        elif cmd == 'o_pressed':
+            self.output_active = not self.output_active
+            if self.output_active:
+                logger.info('Normal output.')
+            else:
+                logger.info('Blackout!')
+        elif cmd.startswith('page:'):
+            self.show_page(int(cmd[5:]))
+        else:
+            logger.debug(f'Ignoring command {cmd!r}.')
+
+    def show_page(self, ix: int):
+        if not 0 <= ix < len(self.pages):
+            logger.warning(f'No page {ix}, ignored.')
+            return
+        logger.info(f'Switching to page {ix}.')
+        self.invalidate()
+        self.page_ix = ix
+        self.dt_remain = self.page_time
+
+    def save_state(self) -> tuple:
+        return (self.page_ix, self.dt_remain, self.frame_no,
+                [page.save_state() for page in self.pages],
+                random.getstate() if self.randomize_pages else None)
+
+    def restore_state(self, state: tuple):
+        self.page_ix, self.dt_remain, self.frame_no, page_states, \
+            random_state = state
+        for page, page_state in zip(self.pages, page_states):
+            page.restore_state(page_state)
+        if random_state is not None:
+            random.setstate(random_state)
+
+    # Drop all frames rendered ahead and rewind pages and timeline to the
+    # frame due next, to be called whenever something changes the content
+    # of frames not yet shown. Output then doesn't depend on render_ahead.
+    def invalidate(self):
+        if self.ring_count:
+            self.restore_state(self.ring_state[self.ring_head])
+        self.ring_count = 0
+
+    def render_single(self, page: LEDPage, out: np.ndarray):
+        if page is not self.cycle_page:
+            self.cycle_cache.clear()
+            self.cycle_page = page
+
+        page.tick(self.dt_secs)
+
+        key = page.cycle_key()
+        cached = None if key is None else self.cycle_cache.get(key)
+        if cached is not None:
+            page.skip()
+            out[...] = cached
+            return
+
+        out[...] = page.get()
+        if key is not None and len(self.cycle_cache) < CYCLE_CACHE_MAX:
+            self.cycle_cache[key] = out.copy()
+
+    # render the next frame into out and advance the page timeline
+    def render_frame(self, out: np.ndarray):
+        if type(self.page_ix) == tuple:
+            ix_a, ix_b = self.page_ix
+            self.pages[ix_a].tick(self.dt_secs)
+            self.pages[ix_b].tick(self.dt_secs)
 
-                if cmd == 'i_pressed':
-                    logger.info('Blitzdings on!')
-                    self.flash_active = True
-                elif cmd == 'i_released':
-                    logger.info('Blitzdings off!')
-                    self.flash_active = False
-                elif cmd == 'o_pressed':
-                    self.output_active = not self.output_active
-                    if self.output_active:
-                        logger.info('Normal output.')
-                    else:
-                        logger.info('Blackout!')
+            fade = self.dt_remain / self.fade_time
 
-            if type(self.page_ix) == tuple:
-                ix_a, ix_b = self.page_ix
-                self.pages[ix_a].tick(self.dt_secs)
-                self.pages[ix_b].tick(self.dt_secs)
+            # try to avoid creation of too many tmp arrays
+            self.fade_img[...] = self.pages[ix_a].get()
+            self.fade_img *= np.power(fade, 3)
 
-                fade = self.dt_remain / self.fade_time
+            self.fade_tmp[...] = self.pages[ix_b].get()
+            self.fade_tmp *= np.power(1 - fade, 3)
+            self.fade_img += self.fade_tmp
 
-                # try to avoid creation of too many tmp arrays
-                self.fade_img[...] = self.pages[ix_a].get()
-                self.fade_img *= np.power(fade, 3)
+            np.clip(self.fade_img, 0, 255, out=self.fade_img)
 
-                self.fade_tmp[...] = self.pages[ix_b].get()
-                self.fade_tmp *= np.power(1 - fade, 3)
-                self.fade_img += self.fade_tmp
+            out[...] = self.fade_img
 
-                self.fade_img = np.clip(self.fade_img, 0, 255)
+        elif type(self.page_ix) == int:
+            self.render_single(self.pages[self.page_ix], out)
+        else:
+            raise RuntimeError(
+                'Fatal error, laxer ix neither tuple nor integer!')
 
-                img = self.fade_img.astype(np.uint8)
+        # after render_single() has cached the bare page
+        if self.overlays:
+            now = self.wall_offset + self.time_base + \
+                self.frame_no * self.dt_secs
+            for overlay in self.overlays:
+                overlay.composite(out, now)
+        self.frame_no += 1
 
+        self.dt_remain -= self.dt_secs
+        if self.dt_remain < 0:
+            if len(self.pages) == 1:
+                # only one page, nothing to do
+                pass
+            elif type(self.page_ix) == tuple:
+                self.page_ix = self.page_ix[1]
+                self.dt_remain = self.page_time
             elif type(self.page_ix) == int:
-                self.pages[self.page_ix].tick(self.dt_secs)
-                img = self.pages[self.page_ix].get()
+                if self.randomize_pages:
+                    # random page, but not the currently displayed
+                    # one
+                    ix_b = random.randint(0, len(self.pages) - 2)
+                    if ix_b >= self.page_ix:
+                        ix_b += 1
+                else:
+                    ix_b = self.page_ix + 1
+                    if ix_b >= len(self.pages):
+                        ix_b = 0
+
+                self.pages[ix_b].x_increment = -1
+                self.page_ix = (self.page_ix, ix_b)
+                self.dt_remain = self.fade_time
             else:
                 raise RuntimeError(
                     'Fatal error, laxer ix neither tuple nor integer!')
 
-            if self.flash_active:
-                self.hw.update(self.all_white_img)
+    # render frames into the ring until it is full, or until the clock
+    # passes the deadline (at least one frame is rendered if the ring is
+    # not full)
+    def fill_ring(self, clock: Optional[Callable[[], float]] = None,
+                  deadline: float = 0.0):
+        n_ring = len(self.ring)
+        while self.ring_count < n_ring:
+            slot = (self.ring_head + self.ring_count) % n_ring
+            self.ring_state[slot] = self.save_state()
+            self.render_frame(self.ring[slot])
+            self.ring_count += 1
+            if clock is not None and clock() >= deadline:
+                break
+
+    def output_frame(self):
+        if not self.ring_count:
+            # only render the frame due now, frame_step() refills the rest
+            logger.debug('Render-ahead ring underrun.')
+            self.ring_state[self.ring_head] = self.save_state()
+            self.render_frame(self.ring[self.ring_head])
+            self.ring_count = 1
+
+        img = self.ring[self.ring_head]
+        if self.flash_active:
+            self.hw.update(self.all_white_img)
+        else:
+            if self.output_active:
+                self.hw.update(img)
             else:
-                if self.output_active:
-                    self.hw.update(img)
-                else:
-                    self.hw.update(self.all_black_img)
-
-            self.dt_remain -= self.dt_secs
-            if self.dt_remain < 0:
-                if len(self.pages) == 1:
-                    # only one page, nothing to do
-                    pass
-                elif type(self.page_ix) == tuple:
-                    self.page_ix = self.page_ix[1]
-                    self.dt_remain = self.page_time
-                elif type(self.page_ix) == int:
-                    if self.randomize_pages:
-                        # random page, but not the currently displayed
-                        # one
-                        ix_b = random.randint(0, len(self.pages) - 2)
-                        if ix_b >= self.page_ix:
-                            ix_b += 1
-                    else:
-                        ix_b = self.page_ix + 1
-                        if ix_b >= len(self.pages):
-                            ix_b = 0
-
-                    self.pages[ix_b].x_increment = -1
-                    self.page_ix = (self.page_ix, ix_b)
-                    self.dt_remain = self.fade_time
-                else:
-                    raise RuntimeError(
-                        'Fatal error, laxer ix neither tuple nor integer!')
+                self.hw.update(self.all_black_img)
+
+        self.ring_head = (self.ring_head + 1) % len(self.ring)
+        self.ring_count -= 1
+
+    # With automatic collection disabled, run the collection the gc would
+    # have triggered by now, but only while waiting for the next frame.
+    def idle_gc(self, clock: Callable[[], float], deadline: float):
+        counts = gc.get_count()
+        thresholds = gc.get_threshold()
+        if clock() + GC_IDLE_MARGIN > deadline and \
+                counts[0] < GC_FORCE_FACTOR * thresholds[0]:
+            return
+
+        for gen in (2, 1, 0):
+            if counts[gen] > thresholds[gen]:
+                gc.collect(gen)
+                return
+
+    # process commands, output one frame on its deadline, then render ahead,
+    # returns the deadline of the next frame
+    def frame_step(self, clock: Callable[[], float], deadline: float) -> float:
+        while not self.cmdq.empty():
+            self.process_cmd(self.cmdq.get_nowait())
+
+        self.output_frame()
+
+        # frames are output on fixed deadlines, rendering only fills
+        # the ring in the remaining time
+        deadline += self.dt_secs
+        now = clock()
+        if now > deadline + len(self.ring) * self.dt_secs:
+            logger.debug(f'Output late by {now - deadline:.3f}s, resyncing.')
+            self.time_base += now - deadline
+            deadline = now
+        self.wall_offset = time.time() - now
+
+        self.fill_ring(clock, deadline)
+        if self.defer_gc:
+            self.idle_gc(clock, deadline)
+        return deadline
+
+    # frame loop deadline of the next frame output, from now on
+    def start_clock(self, now: float) -> float:
+        self.invalidate()
+        self.time_base = now - self.frame_no * self.dt_secs
+        self.wall_offset = time.time() - now
+        return now
+
+    async def mainloop(self):
+        loop = asyncio.get_running_loop()
+        deadline = self.start_clock(loop.time())
+
+        while self.hw.running:
+            deadline = self.frame_step(loop.time, deadline)
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+
+    def threadloop(self, rt_priority: Optional[int],
+                   cpus: Optional[List[int]]):
+        set_thread_scheduling(rt_priority, cpus)
+        deadline = self.start_clock(time.monotonic())
+
+        while self.hw.running:
+            deadline = self.frame_step(time.monotonic, deadline)
+            time.sleep(max(0.0, deadline - time.monotonic()))
+
+    # run the frame loop on its own thread, away from the event loop
+    def start_thread(self, rt_priority: Optional[int] = None,
+                     cpus: Optional[List[int]] = None) -> threading.Thread:
+        thread = threading.Thread(target=self.threadloop, name='render',
+                                  args=(rt_priority, cpus), daemon=True)
+        thread.start()
+        return thread
+
+    # Render n_frames as fast as possible with a simulated clock, applying
+    # the (time, command) entries of timeline when they are due. Output is
+    # a pure function of pages, timeline, random seed and epoch (the wall
+    # clock time overlays see at the first frame), given overlays that
+    # don't depend on the environment (e.g. a ClockOverlay in UTC).
+    def run_virtual(self, n_frames: int, timeline: List[Tuple[float, str]],
+                    epoch: float = 0.0):
+        timeline = sorted(timeline, key=lambda t_cmd: t_cmd[0])
+        cmd_ix = 0
+
+        self.invalidate()
+        self.time_base = -self.frame_no * self.dt_secs
+        self.wall_offset = epoch
+
+        for frame_no in range(n_frames):
+            if not self.hw.running:
+                break
+
+            t = frame_no * self.dt_secs
+            while cmd_ix < len(timeline) and timeline[cmd_ix][0] <= t:
+                self.process_cmd(timeline[cmd_ix][1])
+                cmd_ix += 1
+
+            self.output_frame()
+            self.fill_ring()
+            if self.defer_gc:
+                # simulated time always leaves the whole frame idle
+                self.idle_gc(lambda: t, t + self.dt_secs)
+
+
+# Read a command timeline, one "<seconds> <command>" per line, # comments.
+def read_timeline(fn: Path) -> List[Tuple[float, str]]:
+    timeline = []
+    with fn.open() as f:
+        for line in f:
+            if (ix := line.find('#')) != -1:
+                line = line[:ix]
+            line = line.strip()
+            if not line:
+                continue
 
-            await asyncio.sleep(self.dt_secs)
+            t, cmd = line.split()
+            timeline.append((float(t), cmd))
+    return timeline
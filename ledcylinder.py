@@ -2,98 +2,39 @@
 
 import argparse
 import asyncio
+import gc
 import logging
+import random
 import sys
-from logging import info, exception, warning, debug, error
+from logging import info, exception, warning, error
 from pathlib import Path
+from typing import List
 
-import evdev
-import evdev.ecodes
-
+from led_overlay import ClockOverlay, TextOverlay, NotificationOverlay
 from led_page import LEDPage
-from led_sign import LEDSign
+from led_sign import LEDSign, CommandQueue, read_timeline
 from web_api import LEDCylinderWebApi
 
 
-def scan_for_keyboard():
-    info('Scanning for useable keyboard...')
-
-    for fn in evdev.list_devices():
-        key_dev = evdev.InputDevice(fn)
-        info(f'Trying {fn}: {key_dev}.')
-
-        if not key_dev.name.startswith('PicoMK Pico Keyboard'):
-            info(f' ..skipping, does not start with "PicoMK Pico Keyboard"')
-            continue
-
-        caps = key_dev.capabilities()
-        if not evdev.ecodes.EV_KEY in caps:
-            info(f' ..skipping, does not have EV_KEY capabilities!')
-            continue
-
-        if not evdev.ecodes.KEY_O in caps[evdev.ecodes.EV_KEY]:
-            info(f' ..skipping, does not have an "O" key!')
-            continue
-
-        if not evdev.ecodes.KEY_I in caps[evdev.ecodes.EV_KEY]:
-            info(f' ..skipping, does not have an "I" key!')
-            continue
-
-        info(' ..This keyboard seems useable!')
-        return key_dev
-
-    info('No useable keyboard found.')
-    return None
-
-
-async def keyboard_task(keydev: evdev.InputDevice, cmdq: asyncio.Queue[str]):
-    key_pressed = dict()
-
-    debug(f'Grabbing keyboard device {keydev}...')
-    keydev.grab()
-
-    debug('Running keyboard main loop...')
-    async for evt in keydev.async_read_loop():
-        evt: evdev.InputEvent
-
-        debug(f'{evt}')
-
-        if evt.type != evdev.ecodes.EV_KEY:
-            # info(f'Not EV_KEY event: {evt}.')
+# argparse type for cpu lists like taskset -c: "0,2" or "0-3,6"
+def cpu_list(spec: str) -> List[int]:
+    cpus = set()
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
             continue
-
-        keyname = None
-        if evt.code == evdev.ecodes.KEY_O:
-            keyname = 'o'
-        elif evt.code == evdev.ecodes.KEY_I:
-            keyname = 'i'
-
-        if keyname is None:
-            debug(f'Key not I or O.')
-            continue
-
-        if evt.value and not key_pressed.get(keyname):
-            key_pressed[keyname] = 1
-            keyname += '_pressed'
-        elif not evt.value and key_pressed.get(keyname):
-            key_pressed[keyname] = 0
-            keyname += '_released'
-        else:
-            keyname = None
-
-        if not keyname:
-            continue
-
-        # info(f'Key processing: {keyname}.')
-        cmdq.put_nowait(keyname)
-
-
-async def wrap_keyboard_task(keydev: evdev.InputDevice,
-                             cmdq: asyncio.Queue[str]):
-    try:
-        await keyboard_task(keydev, cmdq)
-    except Exception as exc:
-        exception('Exception caught in keyboard task!')
+        try:
+            first, _, last = item.partition('-')
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'invalid cpu "{item}"')
+        if first < 0 or last < first:
+            raise argparse.ArgumentTypeError(f'invalid cpu range "{item}"')
+        cpus.update(range(first, last + 1))
+    if not cpus:
+        raise argparse.ArgumentTypeError('no cpus given')
+    return sorted(cpus)
 
 
 def main():
@@ -130,13 +71,51 @@ def main():
                      help='Limit brightness of individual pages [def:%(default)d]')
     grp.add_argument('-r', '--randomize-pages', action='store_true',
                      help='Randomize order of pages.')
+    grp.add_argument('-A', '--render-ahead', type=int, metavar='N', default=3,
+                     help='Render up to N frames ahead of output [def:%(default)d]')
+
+    grp = parser.add_argument_group('Overlays')
+
+    grp.add_argument('-c', '--clock', action='store_true',
+                     help='Show a clock on top of the pages')
+    grp.add_argument('--clock-format', type=str, metavar='FMT', default='%H:%M',
+                     help='strftime format of the clock [def:%(default)s]')
+    grp.add_argument('--status', type=str, metavar='TEXT',
+                     help='Show a status line on top of the pages')
+
+    grp = parser.add_argument_group('Frame Timing')
+
+    grp.add_argument('-T', '--render-thread', action='store_true',
+                     help='Run the frame loop on a dedicated thread')
+    grp.add_argument('--rt-priority', type=int, metavar='N',
+                     help='SCHED_FIFO priority N for the render thread, if permitted')
+    grp.add_argument('--cpu-affinity', type=cpu_list, metavar='CPUS',
+                     help='Pin the render thread to CPUS (e.g. 0-3,6), if permitted')
+    grp.add_argument('-G', '--defer-gc', action='store_true',
+                     help='Freeze loaded pages, collect garbage only between frames')
 
     grp = parser.add_argument_group('External Control')
 
-    grp.add_argument('-e', '--evdev', type=str,
-                     help='Support button for flash, use /dev/input/eventXX or "scan"')
+    grp.add_argument('-e', '--evdev', type=str, action='append',
+                     help='Support button for flash, use /dev/input/eventXX or "scan", '
+                          'can be given multiple times, devices may be hotplugged')
     grp.add_argument('-P', '--http-port', type=int,
                      help='enable http-web api on given port')
+    grp.add_argument('-D', '--debug-endpoints', action='store_true',
+                     help='enable /debug/... profiling endpoints on the http-web api')
+
+    grp = parser.add_argument_group('Virtual Clock / Regression Testing')
+
+    grp.add_argument('-V', '--virtual', type=float, metavar='sec',
+                     help='Render sec seconds of simulated time as fast as possible, then exit')
+    grp.add_argument('-t', '--timeline', type=Path, metavar='FILE',
+                     help='Inject commands from FILE ("<sec> <command>" per line)')
+    grp.add_argument('-R', '--record', type=Path, metavar='FILE',
+                     help='Record output frames to FILE instead of showing them')
+    grp.add_argument('-s', '--seed', type=int,
+                     help='Seed for random page order [def: 0 in virtual mode]')
+    grp.add_argument('--epoch', type=float, metavar='sec', default=0.0,
+                     help='Virtual clock time of the first frame, seconds since 1970 UTC [def:%(default).0f]')
 
     parser.add_argument('pages', type=Path, nargs='+')
 
@@ -155,10 +134,28 @@ def main():
         error('Error: Brightness limit cannot be <1 or >255!')
         sys.exit(1)
 
+    if args.seed is not None:
+        random.seed(args.seed)
+    elif args.virtual is not None:
+        random.seed(0)
+
+    cpus = args.cpu_affinity
+    if (args.rt_priority or cpus) and not args.render_thread:
+        warning('--rt-priority and --cpu-affinity only apply to the render '
+                'thread (-T), ignored.')
+
+    if args.simulation and args.render_thread:
+        warning('pygame output from the render thread is not supported on '
+                'all platforms.')
+
     loop = asyncio.new_event_loop()
-    cmdq = asyncio.Queue()
+    cmdq = CommandQueue()
 
-    if args.simulation:
+    if args.record:
+        info(f'Recording frames to {args.record}...')
+        from led_hw_record import HW_Record
+        hw = HW_Record(args.record, args.width, args.height, args.fps)
+    elif args.simulation:
         info('Starting pygame simulator hardware...')
         from led_hw_sim import HW_PyGame
         hw = HW_PyGame(loop, args.width, args.height, 5, cmdq)
@@ -168,7 +165,7 @@ def main():
         hw = HW_USB()
 
     sign = LEDSign(hw, args.page_time, args.fade_time, args.fps, cmdq,
-                   args.randomize_pages)
+                   args.randomize_pages, args.render_ahead, args.defer_gc)
 
     if len(args.pages) == 1 and args.pages[0].is_dir():
         args.pages = sorted(args.pages[0].glob('*'))
@@ -187,32 +184,71 @@ def main():
         except Exception as exc:
             exception(f'Cannot load page {fn}, exception caught!')
 
+    status = None
+    if args.status or args.http_port:
+        # set via /set_status with the web api
+        status = TextOverlay(args.width, args.height, args.status or '',
+                             (255, 255, 255))
+        sign.add_overlay(status)
+    if args.clock:
+        # in UTC with a virtual clock, so recordings don't depend on TZ
+        sign.add_overlay(ClockOverlay(args.width, args.height,
+                                      args.clock_format, (255, 255, 255),
+                                      utc=args.virtual is not None))
+    notification = None
+    if args.http_port:
+        # topmost, pushed via /notify
+        notification = NotificationOverlay(args.width, args.height,
+                                           (255, 255, 255))
+        sign.add_overlay(notification)
+
+    if args.defer_gc:
+        info('Freezing loaded pages, deferring garbage collection.')
+        gc.collect()
+        gc.freeze()
+        gc.disable()
+
+    if args.virtual is not None:
+        timeline = read_timeline(args.timeline) if args.timeline else []
+        n_frames = int(round(args.virtual * args.fps))
+        info(f'Rendering {n_frames} frames with virtual clock...')
+        sign.run_virtual(n_frames, timeline, args.epoch)
+        hw.stop()
+        return
+
+    if args.timeline:
+        warning('Timeline is only used with a virtual clock (-V), ignored.')
+
     if args.http_port:
-        webapi = LEDCylinderWebApi(loop, sign, args.http_port)
+        webapi = LEDCylinderWebApi(loop, sign, args.http_port,
+                                   args.debug_endpoints, notification,
+                                   status)
 
-    key_task = None
+    input_monitor = None
     if args.evdev:
-        key_dev = None
-        try:
-            if args.evdev == "scan":
-                key_dev = scan_for_keyboard()
-            else:
-                key_dev = evdev.InputDevice(args.evdev)
-
-            if key_dev:
-                key_task = loop.create_task(wrap_keyboard_task(key_dev, cmdq))
-                info(f'Using event dev {args.evdev} as control buttons...')
-        except Exception as exc:
-            exception('Could not start evdev handler, exception raised!')
+        from led_input import InputMonitor
+        info(f'Watching for control buttons {", ".join(args.evdev)}...')
+        input_monitor = InputMonitor(cmdq, args.evdev)
+        input_monitor.start(loop)
+
+    render_thread = None
     try:
         info('Starting mainloop..')
-        loop.run_until_complete(sign.mainloop())
+        if args.render_thread:
+            render_thread = sign.start_thread(args.rt_priority, cpus)
+            loop.run_until_complete(
+                loop.run_in_executor(None, render_thread.join))
+        else:
+            loop.run_until_complete(sign.mainloop())
     except KeyboardInterrupt:
-        if args.simulation:
+        if render_thread:
+            hw.running = False
+            render_thread.join()
+        if args.simulation or args.record:
             hw.stop()
 
-    if key_task:
-        key_task.cancel()
+    if input_monitor:
+        input_monitor.stop()
 
 
 if __name__ == '__main__':
@@ -1,18 +1,56 @@
 #!/usr/bin/python
 import asyncio
+import io
 import json
 import logging
+import math
+import sys
+import threading
+import time
+from collections import Counter
+
+from typing import Optional
 
 from aiohttp import web
 
+from led_overlay import NotificationOverlay, TextOverlay
 from led_sign import LEDSign
 
 
+def sample_stacks(seconds: float, interval: float) -> Counter:
+    """
+    Sample the python stacks of all other threads every interval seconds,
+    returns a counter of collapsed stacks ("thread;outer;...;inner").
+    """
+    me = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    stacks = Counter()
+
+    t_end = time.monotonic() + seconds
+    while time.monotonic() < t_end:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            funcs = []
+            while frame is not None:
+                code = frame.f_code
+                funcs.append(f'{code.co_name} ({code.co_filename}:{frame.f_lineno})')
+                frame = frame.f_back
+            funcs.append(names.get(ident, str(ident)))
+            stacks[';'.join(reversed(funcs))] += 1
+        time.sleep(interval)
+
+    return stacks
+
+
 class LEDCylinderWebApi:
     sign: LEDSign
+    notification: Optional[NotificationOverlay]
+    status: Optional[TextOverlay]
     log: logging.Logger
+    debug_busy: bool
 
-    __slots__ = ['sign', 'log']
+    __slots__ = ['sign', 'notification', 'status', 'log', 'debug_busy']
 
     async def handle_http_status(self, req: web.Request) -> web.Response:
         self.log.info('Serving request {req}...')
@@ -39,8 +77,143 @@ class LEDCylinderWebApi:
         self.sign.flash_active = False
         return web.Response(status=200, text='ok')
 
-    def __init__(self, loop: asyncio.AbstractEventLoop, sign: LEDSign, port: int):
+    async def handle_http_notify(self, req: web.Request) -> web.Response:
+        try:
+            duration = float(req.query.get('duration', 5.0))
+        except ValueError as exc:
+            raise web.HTTPBadRequest(text=f'{exc}\n')
+        if not math.isfinite(duration) or duration <= 0:
+            raise web.HTTPBadRequest(text='duration must be finite and > 0\n')
+        self.notification.push(req.query.get('text', ''), duration)
+        return web.Response(status=200, text='ok')
+
+    # empty or no text hides the status line
+    async def handle_http_set_status(self, req: web.Request) -> web.Response:
+        self.status.set_text(req.query.get('text', ''))
+        return web.Response(status=200, text='ok')
+
+    ###
+    # Debug endpoints, only registered with debug=True. All of them take a
+    # ?seconds= argument, run for that long and only one runs at a time.
+    ###
+    def debug_args(self, req: web.Request, **defaults) -> dict:
+        try:
+            ret = {k: type(v)(req.query.get(k, v)) for k, v in
+                   defaults.items()}
+        except ValueError as exc:
+            raise web.HTTPBadRequest(text=f'{exc}\n')
+        if not 0 < ret['seconds'] <= 60:
+            raise web.HTTPBadRequest(text='seconds must be in (0, 60]\n')
+        if 'interval' in ret and not 0 < ret['interval'] <= ret['seconds']:
+            raise web.HTTPBadRequest(text='interval must be in (0, seconds]\n')
+        if 'sort' in ret:
+            import pstats
+            # SortKey values plus the aliases sort_stats() also accepts
+            sort_keys = {k.value for k in pstats.SortKey} | \
+                set(pstats.Stats.sort_arg_dict_default)
+            if ret['sort'] not in sort_keys:
+                raise web.HTTPBadRequest(
+                    text=f'sort must be one of {", ".join(sorted(sort_keys))}\n')
+        if self.debug_busy:
+            raise web.HTTPConflict(text='Another debug request is running.\n')
+        return ret
+
+    # cProfile only sees the event loop thread, use /debug/sample to
+    # include the render thread
+    async def handle_http_debug_profile(self, req: web.Request) -> web.Response:
+        import cProfile
+        import pstats
+
+        args = self.debug_args(req, seconds=5.0, sort='cumulative', limit=40)
+        self.debug_busy = True
+        self.log.info(f'Running cProfile for {args["seconds"]}s...')
+        try:
+            prof = cProfile.Profile()
+            prof.enable()
+            try:
+                await asyncio.sleep(args['seconds'])
+            finally:
+                prof.disable()
+        finally:
+            self.debug_busy = False
+
+        out = io.StringIO()
+        pstats.Stats(prof, stream=out).sort_stats(args['sort']).print_stats(
+            args['limit'])
+        return web.Response(status=200, text=out.getvalue())
+
+    async def handle_http_debug_sample(self, req: web.Request) -> web.Response:
+        args = self.debug_args(req, seconds=5.0, interval=0.005, limit=40)
+        self.debug_busy = True
+        self.log.info(f'Sampling stacks for {args["seconds"]}s...')
+        try:
+            stacks = await asyncio.get_running_loop().run_in_executor(
+                None, sample_stacks, args['seconds'], args['interval'])
+        finally:
+            self.debug_busy = False
+
+        # collapsed stack format, can be fed to flamegraph.pl as is
+        lines = [f'{stack} {n}' for stack, n in
+                 stacks.most_common(args['limit'] or None)]
+        return web.Response(status=200, text='\n'.join(lines) + '\n')
+
+    async def handle_http_debug_tracemalloc(self, req: web.Request) -> web.Response:
+        import tracemalloc
+
+        args = self.debug_args(req, seconds=5.0, limit=25)
+        self.debug_busy = True
+        self.log.info(f'Tracing allocations for {args["seconds"]}s...')
+        started = not tracemalloc.is_tracing()
+        try:
+            if started:
+                tracemalloc.start()
+            snap_a = tracemalloc.take_snapshot()
+            await asyncio.sleep(args['seconds'])
+            snap_b = tracemalloc.take_snapshot()
+        finally:
+            if started:
+                tracemalloc.stop()
+            self.debug_busy = False
+
+        n_frames = max(1, round(args['seconds'] / self.sign.dt_secs))
+        out = [f'Allocation differences over {n_frames} frames:']
+        for stat in snap_b.compare_to(snap_a, 'lineno')[:args['limit']]:
+            out.append(f'{stat.size_diff / n_frames:+10.1f} B/frame '
+                       f'{stat.count_diff / n_frames:+8.2f} blocks/frame  {stat}')
+        return web.Response(status=200, text='\n'.join(out) + '\n')
+
+    async def handle_http_debug_looplag(self, req: web.Request) -> web.Response:
+        args = self.debug_args(req, seconds=5.0, interval=0.01)
+        self.debug_busy = True
+        loop = asyncio.get_running_loop()
+        lags = []
+        try:
+            t_end = loop.time() + args['seconds']
+            while loop.time() < t_end:
+                t_due = loop.time() + args['interval']
+                await asyncio.sleep(args['interval'])
+                lags.append(loop.time() - t_due)
+        finally:
+            self.debug_busy = False
+
+        lags.sort()
+        ret = {
+            'samples': len(lags),
+            'mean': sum(lags) / len(lags),
+            'p50': lags[len(lags) // 2],
+            'p99': lags[min(len(lags) - 1, int(len(lags) * 0.99))],
+            'max': lags[-1],
+        }
+        return web.Response(status=200, body=json.dumps(ret), content_type='application/json')
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, sign: LEDSign, port: int,
+                 debug: bool = False,
+                 notification: Optional[NotificationOverlay] = None,
+                 status: Optional[TextOverlay] = None):
         self.sign = sign
+        self.notification = notification
+        self.status = status
+        self.debug_busy = False
 
         self.log = logging.getLogger(__name__)
         self.log.info(f'Running webserver on port {port}.')
@@ -53,6 +226,18 @@ class LEDCylinderWebApi:
             web.get('/flash_on', self.handle_http_flash_on),
             web.get('/flash_off', self.handle_http_flash_off),
         ])
+        if notification:
+            app.add_routes([web.get('/notify', self.handle_http_notify)])
+        if status:
+            app.add_routes([web.get('/set_status', self.handle_http_set_status)])
+        if debug:
+            self.log.warning('Debug endpoints enabled!')
+            app.add_routes([
+                web.get('/debug/profile', self.handle_http_debug_profile),
+                web.get('/debug/sample', self.handle_http_debug_sample),
+                web.get('/debug/tracemalloc', self.handle_http_debug_tracemalloc),
+                web.get('/debug/looplag', self.handle_http_debug_looplag),
+            ])
 
         runner = web.AppRunner(app)
         loop.run_until_complete(runner.setup())